@@ -5,12 +5,32 @@ This version leverages DuckDB's ability to reference previously defined columns
 in the same SELECT statement to reduce CTEs and simplify the logic.
 """
 
+import gc
+import numpy as np
 import pandas as pd
 import polars as pl
 import duckdb
+import xlsxwriter
 from datetime import datetime
 
 
+# PHP status bytes preserved/written by late-reversal updates
+PHP_BANKRUPTCY = ord('B')
+PHP_DELINQUENT = ord('D')
+
+# Yearly PHP segments in string order: (source column, updated column, update flag)
+PHP_SEGMENTS = (
+    ('pymt_hist_previous_2_yr', 'new_previous_2_yr', 'update_prev_2_yr'),
+    ('pymt_hist_previous_1_yr', 'new_previous_1_yr', 'update_prev_1_yr'),
+    ('pymt_hist_current_yr', 'new_current_yr', 'update_current_yr'),
+)
+
+# Account status -> PHP status code; the PHP byte is the code's digit ('0'-'6')
+ACCOUNT_STATUS_PHP_CODES = {
+    '11': 0, '71': 1, '78': 2, '80': 3, '82': 4, '83': 5, '84': 6,
+}
+
+
 def setup_database():
     """Initialize DuckDB connection with appropriate memory limit."""
     return duckdb.connect('temp.duckdb', config={'memory_limit': '30GB'})
@@ -24,101 +44,116 @@ def load_dates():
     return run_date, run_date_formatted
 
 
+def sas_sentinel_flag(column):
+    """
+    Flag rows where an mm/dd/YYYY text column holds the SAS missing-date
+    sentinel (year 1899). Kept apart from real nulls, which SQL treats differently.
+    """
+    parsed = pl.col(column).str.strptime(pl.Date, '%m/%d/%Y', strict=False)
+    return (parsed.dt.year() == 1899).fill_null(False).alias(f'{column}_is_sentinel')
+
+
 def load_reversal_data(run_date):
     """Load and prepare the main reversal data using Polars."""
     date_columns = [
         'rev_transaction_dt', 'otod', 'sor_dofd', 
         'trans_due_dt', 'rev_eff_date', 'pymt_tran_dt'
     ]
+    # Only these columns are checked for the SAS 1899 missing-date sentinel
+    sentinel_date_columns = ['otod', 'sor_dofd']
     
-    pandas_df = pd.read_excel(f'data/sor_with_cx6_{run_date}.xlsx')
-    pandas_df.columns = [col.lower() for col in pandas_df.columns]
-    
-    df = (
-        pl.from_pandas(pandas_df)
-        .with_columns([
-            pl.col('account_status').cast(pl.Utf8),
-            pl.col(pl.Datetime).cast(pl.Date),
-            pl.col('rev_aftr_30_days').cast(pl.Boolean)
-        ])
+    # calamine parses the workbook in Rust straight into Arrow-backed columns;
+    # infer types from every row, since mostly-null columns like date_closed
+    # would otherwise fall back to text
+    df = pl.read_excel(
+        f'data/sor_with_cx6_{run_date}.xlsx', engine='calamine', infer_schema_length=None
     )
+    df = df.rename({col: col.lower() for col in df.columns})
     
-    for col in date_columns:
-        if col in df.columns:
-            df = df.with_columns(
-                pl.col(col).str.strptime(pl.Date, '%m/%d/%Y', strict=False)
-            )
+    # One projection: Polars runs all casts and date parses in a single parallel pass
+    df = df.with_columns([
+        pl.col('account_status').cast(pl.Utf8),
+        pl.col('account_status').cast(pl.Utf8)
+            .replace_strict(ACCOUNT_STATUS_PHP_CODES, default=None, return_dtype=pl.Int8)
+            .alias('account_status_code'),
+        pl.col(pl.Datetime).cast(pl.Date),
+        pl.col('rev_aftr_30_days').cast(pl.Boolean),
+        # Snapshots taken in the first five days of a month belong to the prior month
+        pl.col('rev_month_snapshot').cast(pl.Date).dt.offset_by('-5d').dt.truncate('1mo')
+            .alias('snapshot_month'),
+        *[
+            pl.col(col).str.strptime(pl.Date, '%m/%d/%Y', strict=False)
+            for col in date_columns if col in df.columns
+        ],
+        *[sas_sentinel_flag(col) for col in sentinel_date_columns],
+        # Original 36-month PHP string, each yearly segment padded to 12 bytes
+        pl.concat_str([
+            pl.col(source_col).cast(pl.Utf8).fill_null('').str.pad_end(12).str.slice(0, 12)
+            for source_col, _, _ in PHP_SEGMENTS
+        ]).alias('php_36_original'),
+    ])
     
     return df
 
 
-def calculate_php_periods(ddc):
-    """Calculate PHP start and end periods for each loan."""
-    return ddc.sql("""
-        SELECT 
-            ln_no,
-            MIN(first_month) as start_month_php,
-            MAX(rev_ss_month) as end_month_php
-        FROM (
+def calculate_php_positions(ddc):
+    """
+    Per-row inputs to the PHP update: the fixed-width 36-byte PHP string, the
+    1-based update window for late reversals and the snapshot position.
+    Materialized as a temp table since it is read once for the rows that need
+    a PHP update and once for the rows that do not.
+    """
+    ddc.execute("""
+        CREATE OR REPLACE TEMP TABLE php_positions AS
+        WITH loan_summary AS (
+            -- One row per loan: PHP period and late reversal flag
             SELECT 
                 ln_no,
-                Rev_Month_Snapshot,
-                Rev_ss_month,
-                Rev_Transaction_dt,
-                MIN(pymt_ss_month) as first_month
+                MIN(pymt_ss_month) as start_month_php,
+                MAX(rev_ss_month) as end_month_php,
+                BOOL_OR(rev_aftr_30_days) as has_late_reversal
             FROM sor_with_cx6
-            GROUP BY ln_no, Rev_Month_Snapshot, Rev_ss_month, Rev_Transaction_dt
+            GROUP BY ln_no
         )
-        GROUP BY ln_no
-    """)
-
-
-def calculate_php_updates(ddc):
-    """
-    Main PHP calculation using DuckDB's column referencing capability.
-    This combines all the logic into fewer, cleaner queries.
-    """
-    return ddc.sql("""
         SELECT 
-            a.*,
+            -- Only the source columns used downstream
+            a.ln_no,
+            a.account_status,
+            a.account_status_code,
+            a.cx6_account_status,
+            a.rev_aftr_30_days,
+            a.rev_month_snapshot,
+            a.snapshot_month,
+            a.rev_transaction_dt,
+            a.pymt_tran_dt,
+            a.sor_dofd,
+            a.sor_dofd_is_sentinel,
+            a.file_date,
+            a.date_closed,
+            a.has_df_tran,
+            a.has_due_date_change,
+            a.payment_history_profile,
+            a.pymt_hist_previous_2_yr,
+            a.pymt_hist_previous_1_yr,
+            a.pymt_hist_current_yr,
+            a.php_36_original,
             
-            -- PHP period information
+            -- PHP period information per loan
             b.start_month_php,
             b.end_month_php,
             
-            -- Calculated fields using previously defined columns
-            CASE 
-                WHEN DAYOFMONTH(a.rev_month_snapshot) < 6
-                THEN DATE_TRUNC('month', a.rev_month_snapshot - INTERVAL 1 MONTH)
-                ELSE DATE_TRUNC('month', a.rev_month_snapshot)
-            END as snapshot_month,
-            
-            -- Original 36-month PHP string
-            CONCAT(a.pymt_hist_previous_2_yr, a.pymt_hist_previous_1_yr, a.pymt_hist_current_yr) as php_36_original,
-            
-            -- PHP start date calculation
-            CASE 
-                WHEN YEAR(a.otod) = 1899 
-                THEN DATE_TRUNC('year', CURRENT_DATE) - INTERVAL 2 YEAR
-                ELSE DATE_TRUNC('year', a.otod) - INTERVAL 2 YEAR
-            END as php_start_date,
+            -- PHP start date calculation (sentinel open date falls back to today)
+            DATE_TRUNC('year', CASE WHEN a.otod_is_sentinel THEN CURRENT_DATE ELSE a.otod END)
+                - INTERVAL 2 YEAR as php_start_date,
             
             -- Loan number formatting
-            LPAD(CAST(a.ln_no AS VARCHAR), 10, '0') as loan_number_padded,
+            PRINTF('%010d', a.ln_no) as loan_number_padded,
             
-            -- Account status mapping
-            CASE 
-                WHEN account_status = '11' THEN '0'
-                WHEN account_status = '71' THEN '1'
-                WHEN account_status = '78' THEN '2'
-                WHEN account_status = '80' THEN '3'
-                WHEN account_status = '82' THEN '4'
-                WHEN account_status = '83' THEN '5'
-                WHEN account_status = '84' THEN '6'
-            END as account_status_php_byte,
+            -- Account status PHP byte ('0'-'6') from the code mapped at load
+            CHR(48 + a.account_status_code) as account_status_php_byte,
             
             -- Check for late reversals per loan
-            MAX(a.rev_aftr_30_days) OVER (PARTITION BY a.ln_no) as has_late_reversal,
+            b.has_late_reversal,
             
             -- Calculate update positions using previously defined columns
             GREATEST(1, DATEDIFF('month', php_start_date, start_month_php) + 1) as update_start_pos,
@@ -131,86 +166,97 @@ def calculate_php_updates(ddc):
                 ELSE NULL
             END as snapshot_php_position,
             
-            -- Build updated PHP string using string functions
-            CASE
-                -- If late reversal, mark all months in scope as 'D', preserving 'B' (bankruptcy)
-                WHEN has_late_reversal THEN
-                    CASE
-                        WHEN update_start_pos > 1 AND update_end_pos < 36 THEN
-                            SUBSTRING(php_36_original, 1, update_start_pos - 1) ||
-                            REGEXP_REPLACE(
-                                SUBSTRING(php_36_original, update_start_pos, update_end_pos - update_start_pos + 1),
-                                '[^B]', 'D', 'g'
-                            ) ||
-                            SUBSTRING(php_36_original, update_end_pos + 1)
-                        WHEN update_start_pos = 1 AND update_end_pos < 36 THEN
-                            REGEXP_REPLACE(
-                                SUBSTRING(php_36_original, 1, update_end_pos),
-                                '[^B]', 'D', 'g'
-                            ) ||
-                            SUBSTRING(php_36_original, update_end_pos + 1)
-                        WHEN update_start_pos > 1 AND update_end_pos = 36 THEN
-                            SUBSTRING(php_36_original, 1, update_start_pos - 1) ||
-                            REGEXP_REPLACE(
-                                SUBSTRING(php_36_original, update_start_pos),
-                                '[^B]', 'D', 'g'
-                            )
-                        ELSE
-                            REGEXP_REPLACE(php_36_original, '[^B]', 'D', 'g')
-                    END
-                
-                -- If no late reversal, update specific snapshot positions with account status
-                WHEN NOT has_late_reversal AND snapshot_php_position IS NOT NULL AND account_status_php_byte IS NOT NULL THEN
-                    CASE
-                        WHEN snapshot_php_position = 1 THEN
-                            account_status_php_byte || SUBSTRING(php_36_original, 2)
-                        WHEN snapshot_php_position = 36 THEN
-                            SUBSTRING(php_36_original, 1, 35) || account_status_php_byte
-                        ELSE
-                            SUBSTRING(php_36_original, 1, snapshot_php_position - 1) ||
-                            account_status_php_byte ||
-                            SUBSTRING(php_36_original, snapshot_php_position + 1)
-                    END
-                    
-                -- Otherwise keep original
-                ELSE php_36_original
-            END as php_36_updated,
-            
-            -- Split updated PHP into yearly segments using the updated string
-            SUBSTRING(php_36_updated, 1, 12) as new_previous_2_yr,
-            SUBSTRING(php_36_updated, 13, 12) as new_previous_1_yr,
-            SUBSTRING(php_36_updated, 25, 12) as new_current_yr,
-            
-            -- Update indicators using the new yearly segments
-            CASE WHEN new_previous_2_yr <> a.pymt_hist_previous_2_yr THEN 'Y' ELSE 'N' END as update_prev_2_yr,
-            CASE WHEN new_previous_1_yr <> a.pymt_hist_previous_1_yr THEN 'Y' ELSE 'N' END as update_prev_1_yr,
-            CASE WHEN new_current_yr <> a.pymt_hist_current_yr THEN 'Y' ELSE 'N' END as update_current_yr
+            -- Only these rows can have their PHP changed; the rest skip the PHP kernel
+            COALESCE(
+                has_late_reversal
+                OR (NOT has_late_reversal AND snapshot_php_position IS NOT NULL AND account_status_php_byte IS NOT NULL),
+                FALSE
+            ) as needs_php_update
             
         FROM sor_with_cx6 a
-        LEFT JOIN calculate_php_periods b ON a.ln_no = b.ln_no
+        LEFT JOIN loan_summary b ON a.ln_no = b.ln_no
     """)
+    return ddc.table("php_positions")
+
+
+def apply_php_updates(php, start_pos, end_pos, snapshot_pos, status_byte, has_late):
+    """
+    Update an (N, 36) uint8 array of PHP strings in place.
+
+    Rows with a late reversal get every byte in [start_pos, end_pos] set to
+    'D', preserving 'B' (bankruptcy). Other rows get the byte at snapshot_pos
+    set to the account status byte. Positions are 1-based; a position or
+    status byte of 0 means no update.
+    """
+    months = np.arange(1, php.shape[1] + 1)
+    in_scope = (
+        has_late[:, None]
+        & (months >= start_pos[:, None])
+        & (months <= end_pos[:, None])
+    )
+    php[in_scope & (php != PHP_BANKRUPTCY)] = PHP_DELINQUENT
+
+    rows = np.flatnonzero(
+        ~has_late
+        & (snapshot_pos >= 1)
+        & (snapshot_pos <= php.shape[1])
+        & (status_byte != 0)
+    )
+    php[rows, snapshot_pos[rows] - 1] = status_byte[rows]
+    return php
 
 
-def calculate_cx6_updates(ddc):
-    """Calculate CX6 PHP updates in a single query."""
+def calculate_php_updates(ddc):
+    """
+    Main PHP calculation. The byte-level PHP update runs as a NumPy kernel
+    over the fixed-width strings, which are then split into yearly segments
+    and compared byte-wise; DuckDB derives the CX6 PHP updates on the same rows.
+    """
+    calculate_php_positions(ddc)
+    
+    # Only rows whose PHP can change leave DuckDB for the kernel
+    candidates = ddc.sql("SELECT * FROM php_positions WHERE needs_php_update").pl()
+    
+    original = candidates['php_36_original'].to_numpy().astype('S36').view(np.uint8).reshape(-1, 36)
+    php = apply_php_updates(
+        original.copy(),
+        candidates['update_start_pos'].fill_null(0).to_numpy(),
+        candidates['update_end_pos'].fill_null(0).to_numpy(),
+        candidates['snapshot_php_position'].fill_null(0).to_numpy(),
+        (candidates['account_status_code'].cast(pl.UInt8) + ord('0')).fill_null(0).to_numpy(),
+        candidates['has_late_reversal'].fill_null(False).to_numpy(),
+    )
+    
+    # Split into 12-byte yearly segments and flag the ones that changed;
+    # segments missing from the source stay missing and are never flagged
+    segment_columns = []
+    for i, (source_col, new_col, flag_col) in enumerate(PHP_SEGMENTS):
+        before = original[:, i * 12:(i + 1) * 12]
+        after = php[:, i * 12:(i + 1) * 12]
+        present = candidates[source_col].is_not_null().to_numpy()
+        segment = np.char.decode(np.ascontiguousarray(after).view('S12').ravel(), 'ascii')
+        segment_columns += [
+            pl.Series(new_col, np.where(present, segment, None), dtype=pl.Utf8),
+            pl.Series(flag_col, np.where(present & np.any(after != before, axis=1), 'Y', 'N')),
+        ]
+    ddc.register("php_candidates", candidates.with_columns(segment_columns))
+    
     return ddc.sql("""
         SELECT 
-            a.ln_no,
-            a.payment_history_profile,
-            a.file_date,
-            b.start_month_php as payment_date,
+            a.*,
             
-            -- Calculate months between payment and file date
-            DATEDIFF('month', payment_date, a.file_date) as months_between,
+            -- CX6: months between first payment and file date
+            DATEDIFF('month', a.start_month_php, a.file_date) as months_between,
             
             -- CX6 PHP update logic using the months_between calculation
             CASE
                 WHEN a.payment_history_profile IS NULL THEN NULL
                 WHEN months_between <= 1 THEN a.payment_history_profile
                 ELSE 
-                    REGEXP_REPLACE(
+                    -- Static character map: statuses 0-6 and J/K/L become 'D'
+                    TRANSLATE(
                         SUBSTRING(a.payment_history_profile, 1, months_between - 1),
-                        '[123456JKL0]', 'D', 'g'
+                        '0123456JKL', 'DDDDDDDDDD'
                     ) ||
                     SUBSTRING(a.payment_history_profile, months_between)
             END as cx6_php_updated,
@@ -225,17 +271,32 @@ def calculate_cx6_updates(ddc):
                 ELSE NULL
             END as cx6_accurate_php_updated
             
-        FROM calculate_php_updates a
-        LEFT JOIN calculate_php_periods b ON a.ln_no = b.ln_no
+        FROM (
+            SELECT * FROM php_candidates
+            UNION ALL BY NAME
+            SELECT 
+                *,
+                pymt_hist_previous_2_yr as new_previous_2_yr,
+                pymt_hist_previous_1_yr as new_previous_1_yr,
+                pymt_hist_current_yr as new_current_yr,
+                'N' as update_prev_2_yr,
+                'N' as update_prev_1_yr,
+                'N' as update_current_yr
+            FROM php_positions
+            WHERE NOT needs_php_update
+        ) a
     """)
 
 
-def generate_final_output(ddc):
-    """Generate the final output report."""
-    return ddc.sql("""
+def generate_final_output(php_updates):
+    """
+    Generate the final output report. Chained onto the PHP updates relation
+    so DuckDB plans the updates and the report as a single query.
+    """
+    return php_updates.query("php_updates", """
         SELECT 
             -- Account identifiers
-            CONCAT('51', a.loan_number_padded) as "CX6 Account Number",
+            PRINTF('51%010d', a.ln_no) as "CX6 Account Number",
             STRFTIME(a.pymt_tran_dt, '%m/%d/%Y') as "PMT_TRANSACTION_DT",
             STRFTIME(a.rev_month_snapshot, '%m/%d/%Y') as "Impacted_Snapshot",
             
@@ -255,7 +316,7 @@ def generate_final_output(ddc):
             a.cx6_account_status as "account_sts_CX6",
             
             -- CX6 PHP information
-            COALESCE(b.cx6_accurate_php_updated, b.cx6_php_updated) as "What CX6 PHP string should be",
+            COALESCE(a.cx6_accurate_php_updated, a.cx6_php_updated) as "What CX6 PHP string should be",
             a.payment_history_profile,
             
             -- CX6 PHP update indicator using the coalesced value
@@ -283,8 +344,7 @@ def generate_final_output(ddc):
             -- DOFD information
             STRFTIME(a.sor_dofd, '%m/%d/%Y') as "L_CB_1ST_DLQ_DATE",
             CASE
-                WHEN a.sor_dofd IS NOT NULL
-                     AND YEAR(a.sor_dofd) <> 1899
+                WHEN a.sor_dofd IS NOT NULL AND NOT a.sor_dofd_is_sentinel
                      AND (a.account_status = '11' OR a.rev_aftr_30_days)
                 THEN 'Y' ELSE 'N' 
             END as "DOFD Update Indicator",
@@ -303,7 +363,7 @@ def generate_final_output(ddc):
             END as "Previous 1 Year Update",
             
             CASE 
-                WHEN a.sor_dofd IS NOT NULL AND YEAR(a.sor_dofd) <> 1899 AND a.account_status = '11'
+                WHEN a.sor_dofd IS NOT NULL AND NOT a.sor_dofd_is_sentinel AND a.account_status = '11'
                 THEN CONCAT(a.loan_number_padded, '////', STRFTIME(a.sor_dofd, '%m%d%y'), '/', '0')
             END as "DOFD Update",
             
@@ -332,11 +392,22 @@ def generate_final_output(ddc):
                 ELSE 'Y - Multi' 
             END as "Requires_Manual_Review"
             
-        FROM calculate_php_updates a
-        LEFT JOIN calculate_cx6_updates b ON a.ln_no = b.ln_no
+        FROM php_updates a
     """)
 
 
+def write_worksheet(workbook, sheet_name, df):
+    """
+    Write a Polars DataFrame to a new worksheet row by row. The header row
+    gets the bold, bordered style pandas' to_excel used.
+    """
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, df.columns, header_format)
+    for row_index, row in enumerate(df.iter_rows(), start=1):
+        worksheet.write_row(row_index, 0, row)
+
+
 def main():
     """Main execution function."""
     print("Starting clean PHP calculation process...")
@@ -346,35 +417,40 @@ def main():
     run_date, run_date_formatted = load_dates()
     print(f"Processing data for run date: {run_date}")
     
-    # Load data
+    # Load data; the cyclic GC has nothing to reclaim while large frames are
+    # being built, so keep it from sweeping until the load is done
     print("Loading reversal data...")
-    reversal_data = load_reversal_data(run_date)
-    ddc.register("sor_with_cx6", reversal_data.to_pandas())
-    
-    # Register views in order
-    print("Calculating PHP periods...")
-    ddc.register("calculate_php_periods", calculate_php_periods(ddc))
+    gc.disable()
+    try:
+        reversal_data = load_reversal_data(run_date)
+        ddc.register("sor_with_cx6", reversal_data)
+    finally:
+        gc.collect()
+        gc.enable()
     
     print("Calculating PHP updates...")
-    ddc.register("calculate_php_updates", calculate_php_updates(ddc))
-    
-    print("Calculating CX6 updates...")
-    ddc.register("calculate_cx6_updates", calculate_cx6_updates(ddc))
+    php_updates = calculate_php_updates(ddc)
     
     # Generate final output
     print("Generating final output...")
-    output_df = generate_final_output(ddc).df()
+    output_df = generate_final_output(php_updates).pl()
+    
+    # Parquet copy of the report for downstream processing
+    parquet_filename = f'data/AFS_Pymt_Rev_GoFrwd_{run_date_formatted}_clean.parquet'
+    output_df.write_parquet(parquet_filename, compression='zstd')
+    print(f"Parquet copy saved to: {parquet_filename}")
     
     # Create Excel report
     print("Creating Excel report...")
-    report_label = pd.DataFrame({
+    report_label = pl.DataFrame({
         'report_label': ['Wells Fargo Confidential, Not for Remediation.']
     })
     
+    # constant_memory streams rows to disk instead of holding every cell in memory
     output_filename = f'data/AFS_Pymt_Rev_GoFrwd_{run_date_formatted}_clean.xlsx'
-    with pd.ExcelWriter(output_filename) as writer:
-        output_df.to_excel(writer, sheet_name='Reversals', index=False)
-        report_label.to_excel(writer, sheet_name='report_label', index=False)
+    with xlsxwriter.Workbook(output_filename, {'constant_memory': True}) as workbook:
+        write_worksheet(workbook, 'Reversals', output_df)
+        write_worksheet(workbook, 'report_label', report_label)
     
     print(f"Report saved to: {output_filename}")
     print("Clean PHP calculation completed successfully!")
@@ -1,62 +1,90 @@
 #!/usr/bin/env python3
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import argparse
 
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
 def get_human_readable_size(size_bytes: int) -> str:
     """Convert bytes to human readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.1f}{unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.1f}PB"
+    if size_bytes < 1024:
+        return f"{size_bytes:.1f}B"
+    # Each unit is a 10-bit shift, so the unit index comes from the bit length
+    idx = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (idx * 10)):.1f}{_SIZE_UNITS[idx]}"
 
-def get_directory_size(directory: Path) -> int:
-    """Calculate total size of a directory and its subdirectories."""
+def _walk(directory: str, sizes: Optional[Dict[str, int]]) -> int:
+    """
+    Return the total size of a directory, recording the total of it and every
+    non-hidden subdirectory in sizes. Hidden subdirectories still count toward
+    their parents but are not recorded (sizes is None beneath them).
+    """
     total_size = 0
     try:
-        for root, dirs, files in os.walk(directory, followlinks=False):
-            for name in files:
+        with os.scandir(directory) as entries:
+            for entry in entries:
                 try:
-                    file_path = Path(root) / name
-                    if not file_path.is_symlink():
-                        total_size += file_path.stat().st_size
+                    if entry.is_file(follow_symlinks=False):
+                        total_size += entry.stat(follow_symlinks=False).st_size
+                    elif entry.is_dir(follow_symlinks=False):
+                        hidden = sizes is None or entry.name.startswith('.')
+                        total_size += _walk(entry.path, None if hidden else sizes)
                 except (PermissionError, OSError):
                     continue
     except (PermissionError, OSError):
         pass
+    if sizes is not None:
+        sizes[directory] = total_size
     return total_size
 
+def _walk_subtree(directory: str, hidden: bool) -> Tuple[int, Dict[str, int]]:
+    """Walk one top-level subdirectory, returning its total and recorded sizes."""
+    sizes: Dict[str, int] = {}
+    return _walk(directory, None if hidden else sizes), sizes
+
 def analyze_directories(start_path: str = '.') -> List[Tuple[str, int]]:
     """
     Analyze all directories recursively and return list of (path, size) tuples.
     """
-    directory_sizes = []
     start_path = Path(start_path).resolve()
+    root = str(start_path)
+    sizes: Dict[str, int] = {}
+    total_size = 0
     
-    # Walk through directories using os.walk
-    for root, dirs, _ in os.walk(start_path, followlinks=False):
-        # Remove hidden directories from dirs list in-place
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
+    # Traversal is syscall-bound and releases the GIL, so walk each
+    # top-level subdirectory in its own thread
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False):
+                            total_size += entry.stat(follow_symlinks=False).st_size
+                        elif entry.is_dir(follow_symlinks=False):
+                            futures.append(executor.submit(
+                                _walk_subtree, entry.path, entry.name.startswith('.')
+                            ))
+                    except (PermissionError, OSError):
+                        continue
+        except (PermissionError, OSError):
+            pass
         
-        for dir_name in dirs:
-            try:
-                dir_path = Path(root) / dir_name
-                if not dir_path.is_symlink():
-                    size = get_directory_size(dir_path)
-                    directory_sizes.append((str(dir_path), size))
-            except (PermissionError, OSError):
-                continue
+        for future in futures:
+            subtree_size, subtree_sizes = future.result()
+            total_size += subtree_size
+            sizes.update(subtree_sizes)
     
     # Add the start directory itself
     if not start_path.parts[-1].startswith('.') and not start_path.is_symlink():
-        size = get_directory_size(start_path)
-        directory_sizes.append((str(start_path), size))
+        sizes[root] = total_size
     
     # Sort by size (largest first)
-    return sorted(directory_sizes, key=lambda x: x[1], reverse=True)
+    return sorted(sizes.items(), key=lambda x: x[1], reverse=True)
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze directory sizes recursively')
@@ -5,11 +5,17 @@ Uses rsync for efficient copying with progress reporting.
 """
 
 import os
+import stat
 import sys
 import subprocess
+import time
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatchcase
 from pathlib import Path
-from typing import List, Optional
+from typing import FrozenSet, Iterator, List, Optional, Tuple
+
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
 
 
 def copy_directory_with_exclusions(
@@ -17,7 +23,8 @@ def copy_directory_with_exclusions(
     dest_dir: str,
     exclude_dirs: List[str],
     use_rsync: bool = True,
-    verbose: bool = True
+    verbose: bool = True,
+    debug: bool = False
 ) -> bool:
     """
     Copy a directory recursively while excluding certain subdirectories.
@@ -32,6 +39,7 @@ def copy_directory_with_exclusions(
                      - Absolute paths: "/home/user/project/temp"
         use_rsync: Use rsync if available (more efficient)
         verbose: Show progress information
+        debug: Have rsync list every file it copies
     
     Returns:
         bool: True if successful, False otherwise
@@ -40,37 +48,45 @@ def copy_directory_with_exclusions(
     source_dir = os.path.abspath(source_dir)
     dest_dir = os.path.abspath(dest_dir)
     
-    # Validate source directory
-    if not os.path.exists(source_dir):
+    # Validate source directory with a single stat() call
+    try:
+        source_stat = os.stat(source_dir)
+    except OSError:
         print(f"Error: Source directory '{source_dir}' does not exist.")
         return False
     
-    if not os.path.isdir(source_dir):
+    if not stat.S_ISDIR(source_stat.st_mode):
         print(f"Error: '{source_dir}' is not a directory.")
         return False
     
+    # Nothing to do when copying a directory onto itself
+    if source_dir == dest_dir:
+        print(f"Source and destination are both '{source_dir}', nothing to copy.")
+        return True
+    
     # Create destination directory if it doesn't exist
     os.makedirs(dest_dir, exist_ok=True)
     
     # Process exclude list to handle both absolute and relative paths
     processed_excludes = _process_exclude_list(exclude_dirs, source_dir)
+    compiled_excludes = _compile_excludes(processed_excludes)
     
     # Check if rsync is available
     if use_rsync and shutil.which('rsync'):
-        return _copy_with_rsync(source_dir, dest_dir, processed_excludes, verbose)
+        return _copy_with_rsync(source_dir, dest_dir, processed_excludes, verbose, debug)
     else:
         if use_rsync:
             print("rsync not found, falling back to cp command...")
-        return _copy_with_cp(source_dir, dest_dir, processed_excludes, verbose)
+        return _copy_with_cp(source_dir, dest_dir, compiled_excludes, verbose)
 
 
 def _process_exclude_list(exclude_dirs: List[str], source_dir: str) -> List[str]:
     """
     Process exclude list to handle absolute paths, relative paths, and simple names.
     Returns a list suitable for rsync exclusion patterns.
+    source_dir must already be an absolute path.
     """
     processed = []
-    source_dir = os.path.abspath(source_dir)
     
     for exclude in exclude_dirs:
         exclude = exclude.strip()
@@ -100,15 +116,20 @@ def _copy_with_rsync(
     source_dir: str,
     dest_dir: str,
     exclude_dirs: List[str],
-    verbose: bool
+    verbose: bool,
+    debug: bool = False
 ) -> bool:
     """Copy using rsync command for efficiency and progress reporting."""
     # Build rsync command
-    cmd = ['rsync', '-av']  # -a for archive mode, -v for verbose
+    cmd = ['rsync', '-a']  # -a for archive mode
     
     if verbose:
-        cmd.append('--progress')  # Show progress for each file
         cmd.append('--info=progress2')  # Show overall progress
+        cmd.append('--no-inc-recursive')  # Scan the tree up front so the total is known
+    
+    if debug:
+        cmd.append('-v')  # List every file
+        cmd.append('--progress')  # Show progress for each file
     
     # Add exclusions
     for exclude in exclude_dirs:
@@ -139,81 +160,91 @@ def _copy_with_rsync(
 def _copy_with_cp(
     source_dir: str,
     dest_dir: str,
-    exclude_dirs: List[str],
+    excludes: Tuple[FrozenSet[str], FrozenSet[str]],
     verbose: bool
 ) -> bool:
-    """Fallback method using cp command with find for exclusions."""
+    """
+    Fallback method copying in-process with shutil and a scandir walk for exclusions.
+    excludes is the (names, paths) pair returned by _compile_excludes.
+    """
+    exclude_names, exclude_paths = excludes
+    
     print(f"Copying from '{source_dir}' to '{dest_dir}'...")
-    if exclude_dirs:
-        print(f"Excluding: {', '.join(exclude_dirs)}")
+    if exclude_names or exclude_paths:
+        print(f"Excluding: {', '.join(sorted(exclude_names | exclude_paths))}")
     print("-" * 50)
     
-    # First, get total size for progress estimation
-    if verbose:
-        total_size = _get_directory_size(source_dir, exclude_dirs)
-        print(f"Total size to copy: {_format_bytes(total_size)}")
-        copied_size = 0
-    
-    # Build find command to list files excluding certain directories
-    find_cmd = ['find', source_dir]
-    
-    # Add exclusions to find command
-    if exclude_dirs:
-        find_cmd.append('(')
-        for i, exclude in enumerate(exclude_dirs):
-            if i > 0:
-                find_cmd.append('-o')
-            
-            # Handle both simple names and paths
-            if '/' in exclude:
-                # It's a path - use full path matching
-                full_exclude_path = os.path.join(source_dir, exclude)
-                find_cmd.extend(['-path', full_exclude_path, '-prune'])
-            else:
-                # It's a simple name - match anywhere
-                find_cmd.extend(['-name', exclude, '-prune'])
-        find_cmd.append(')')
-        find_cmd.append('-o')
-    
-    find_cmd.extend(['-type', 'f', '-print'])
-    
     try:
-        # Get list of files to copy
-        result = subprocess.run(find_cmd, capture_output=True, text=True, check=True)
-        files = result.stdout.strip().split('\n')
-        files = [f for f in files if f]  # Remove empty strings
+        # Copy files in-process as the scandir walk finds them; shutil.copy2
+        # uses the kernel's sendfile / copy_file_range fast path on Linux and
+        # threads overlap the I/O waits
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        max_in_flight = workers * 4
+        entries = _walk_files(source_dir, exclude_names, exclude_paths)
+        walk_done = False
+        in_flight = {}
+        created = {''}  # dest_dir itself already exists
+        total_files = total_size = 0
+        copied_files = copied_size = 0
         
-        total_files = len(files)
-        print(f"Found {total_files} files to copy\n")
+        # Redraw progress at most every 0.1s or 5 MB, and only on a terminal;
+        # the totals grow until the walk has finished
+        show_progress = verbose and sys.stdout.isatty()
+        last_update = time.monotonic()
+        last_size = 0
         
-        # Copy each file
-        for i, file_path in enumerate(files):
-            # Calculate relative path
-            rel_path = os.path.relpath(file_path, source_dir)
-            dest_path = os.path.join(dest_dir, rel_path)
-            
-            # Create destination directory
-            dest_file_dir = os.path.dirname(dest_path)
-            os.makedirs(dest_file_dir, exist_ok=True)
-            
-            # Copy file
-            subprocess.run(['cp', '-p', file_path, dest_path], check=True)
-            
-            if verbose:
-                # Show progress
-                file_size = os.path.getsize(file_path)
-                copied_size += file_size
-                progress = (i + 1) / total_files * 100
-                size_progress = copied_size / total_size * 100 if total_size > 0 else 0
-                
-                print(f"\rProgress: {i+1}/{total_files} files ({progress:.1f}%) | "
-                      f"{_format_bytes(copied_size)}/{_format_bytes(total_size)} ({size_progress:.1f}%)", 
-                      end='', flush=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # Keep the pool fed until the window is full or the walk is done
+                    while not walk_done and len(in_flight) < max_in_flight:
+                        entry = next(entries, None)
+                        if entry is None:
+                            walk_done = True
+                            break
+                        rel_path, size = entry
+                        total_files += 1
+                        total_size += size
+                        
+                        # Create each destination directory once, not per file
+                        rel_dir = os.path.dirname(rel_path)
+                        if rel_dir not in created:
+                            os.makedirs(os.path.join(dest_dir, rel_dir), exist_ok=True)
+                            created.add(rel_dir)
+                        
+                        future = executor.submit(
+                            shutil.copy2,
+                            os.path.join(source_dir, rel_path),
+                            os.path.join(dest_dir, rel_path)
+                        )
+                        in_flight[future] = size
+                    
+                    if not in_flight:
+                        break
+                    
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        copied_files += 1
+                        copied_size += in_flight.pop(future)
+                    
+                    if show_progress:
+                        now = time.monotonic()
+                        if now - last_update >= 0.1 or copied_size - last_size >= 5 * 1024 * 1024:
+                            _print_progress(copied_files, total_files, copied_size, total_size)
+                            last_update = now
+                            last_size = copied_size
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        
+        if verbose:
+            _print_progress(total_files, total_files, copied_size, total_size)
         
         print("\n\nCopy completed successfully!")
         return True
         
-    except subprocess.CalledProcessError as e:
+    except OSError as e:
         print(f"\nError during copy: {e}")
         return False
     except KeyboardInterrupt:
@@ -221,56 +252,60 @@ def _copy_with_cp(
         return False
 
 
-def _get_directory_size(path: str, exclude_dirs: List[str]) -> int:
-    """Calculate total size of directory excluding certain subdirectories."""
-    total_size = 0
-    path = os.path.abspath(path)
-    
-    for dirpath, dirnames, filenames in os.walk(path):
-        # Check if current directory should be excluded
-        rel_dir = os.path.relpath(dirpath, path)
-        
-        # Remove excluded directories from dirnames to prevent walking into them
-        new_dirnames = []
-        for dirname in dirnames:
-            # Check against all exclusion patterns
-            should_exclude = False
-            dir_rel_path = os.path.join(rel_dir, dirname) if rel_dir != '.' else dirname
-            
-            for exclude in exclude_dirs:
-                if '/' in exclude:
-                    # Path-based exclusion
-                    if dir_rel_path == exclude or dir_rel_path.startswith(exclude + '/'):
-                        should_exclude = True
-                        break
-                else:
-                    # Name-based exclusion
-                    if dirname == exclude:
-                        should_exclude = True
-                        break
-            
-            if not should_exclude:
-                new_dirnames.append(dirname)
-        
-        dirnames[:] = new_dirnames
-        
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            try:
-                total_size += os.path.getsize(filepath)
-            except (OSError, IOError):
-                pass
-    
-    return total_size
+def _print_progress(copied_files: int, total_files: int, copied_size: int, total_size: int) -> None:
+    """Redraw the single-line copy progress indicator."""
+    progress = copied_files / total_files * 100 if total_files > 0 else 100
+    size_progress = copied_size / total_size * 100 if total_size > 0 else 100
+    sys.stdout.write(f"\rProgress: {copied_files}/{total_files} files ({progress:.1f}%) | "
+                     f"{_format_bytes(copied_size)}/{_format_bytes(total_size)} ({size_progress:.1f}%)")
+    sys.stdout.flush()
+
+
+def _compile_excludes(exclude_dirs: List[str]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """
+    Split processed excludes into a set of simple names and a set of
+    relative paths (trailing slashes stripped), so duplicates collapse and
+    membership checks are O(1).
+    """
+    names = frozenset(e for e in exclude_dirs if '/' not in e)
+    paths = frozenset(e.rstrip('/') for e in exclude_dirs if '/' in e)
+    return names, paths
+
+
+def _walk_files(
+    root: str,
+    exclude_names: FrozenSet[str],
+    exclude_paths: FrozenSet[str]
+) -> Iterator[Tuple[str, int]]:
+    """
+    Yield (relative_path, size) for every regular file under root, pruning
+    entries whose name matches exclude_names (glob patterns allowed) or whose
+    relative path is in exclude_paths. Symlinks are not followed.
+    """
+    name_globs = tuple(n for n in exclude_names if any(c in n for c in '*?['))
+    stack = [('', root)]
+    while stack:
+        rel_dir, directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                if (name in exclude_names or rel_path in exclude_paths
+                        or any(fnmatchcase(name, pattern) for pattern in name_globs)):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((rel_path, entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    yield rel_path, entry.stat(follow_symlinks=False).st_size
 
 
 def _format_bytes(size: int) -> str:
     """Format bytes into human-readable string."""
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024.0:
-            return f"{size:.1f} {unit}"
-        size /= 1024.0
-    return f"{size:.1f} PB"
+    if size < 1024:
+        return f"{size:.1f} B"
+    # Each unit is a 10-bit shift, so the unit index comes from the bit length
+    idx = min((size.bit_length() - 1) // 10, len(_UNITS) - 1)
+    return f"{size / (1 << (idx * 10)):.1f} {_UNITS[idx]}"
 
 
 # Example usage